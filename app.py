@@ -11,48 +11,160 @@ st.set_page_config(
     layout="wide"
 )
 
-# --- Core KPI Calculation Function (Unchanged) ---
-# This powerful function is the engine of the report and does not need to be changed.
-def calculate_kpis(sub_df):
-    """Calculates a comprehensive list of KPIs for a given subset of leads."""
-    if sub_df.empty:
-        return {}
-    kpis = {}
-    num_leads_created = len(sub_df)
-    qualified_leads_df = sub_df[sub_df['isQualified'] == 1]
-    num_qualified_leads = len(qualified_leads_df)
-    kpis['# of Leads Created (Salesforce)'] = num_leads_created
-    kpis['# of Qualified leads'] = num_qualified_leads
-    kpis['% Qualified Leads of Leads Created'] = (num_qualified_leads / num_leads_created * 100) if num_leads_created > 0 else 0
-    attempted_qualified_leads_df = qualified_leads_df[qualified_leads_df['is_Lead_Called'] == 1]
-    num_attempted_qualified = len(attempted_qualified_leads_df)
-    kpis['# of Leads Attempted'] = num_attempted_qualified
-    kpis['Attempt% of Qualified leads'] = (num_attempted_qualified / num_qualified_leads * 100) if num_qualified_leads > 0 else 0
-    connected_qualified_leads_df = qualified_leads_df[qualified_leads_df['is_Lead_Connected'] == 1]
-    num_connected_qualified = len(connected_qualified_leads_df)
-    kpis['# of Leads Connected'] = num_connected_qualified
-    kpis['Connection % of Qualified Leads'] = (num_connected_qualified / num_qualified_leads * 100) if num_qualified_leads > 0 else 0
-    kpis['Time to First Attempt (P50) in hours'] = sub_df['TimeDiffLeadAttempt_hours'].dropna().quantile(0.50)
-    kpis['Time to First Attempt (P90) in hours'] = sub_df['TimeDiffLeadAttempt_hours'].dropna().quantile(0.90)
-    kpis['Time to First Connect (P50) in hours'] = sub_df['TimeDiffLeadConnect_hours'].dropna().quantile(0.50)
-    kpis['Time to First Connect (P90) in hours'] = sub_df['TimeDiffLeadConnect_hours'].dropna().quantile(0.90)
-    total_attempted_df = sub_df[sub_df['is_Lead_Called'] == 1]
-    total_connected_df = sub_df[sub_df['is_Lead_Connected'] == 1]
-    attempted_after_24h = total_attempted_df[total_attempted_df['TimeDiffLeadAttempt_hours'] > 24].shape[0]
-    kpis['% Contri. of Leads Attempted after 24 hours'] = (attempted_after_24h / len(total_attempted_df) * 100) if not total_attempted_df.empty else 0
-    connected_after_24h = total_connected_df[total_connected_df['TimeDiffLeadConnect_hours'] > 24].shape[0]
-    kpis['% Contri. of Leads Contacted after 24 hours'] = (connected_after_24h / len(total_connected_df) * 100) if not total_connected_df.empty else 0
+# --- Core KPI Calculation Functions ---
+def aggregate_segments(grouped):
+    """Aggregates the raw counts and percentiles behind the KPIs for each group of leads."""
+    # Every counter is summed in one pass over the block of flag columns instead of one aggregation per KPI
+    flag_counts = {
+        'is_qualified': 'qualified', 'is_attempted_qual': 'attempted_qual', 'is_connected_qual': 'connected_qual',
+        'is_attempted': 'attempted', 'attempt_gt24': 'attempted_gt24',
+        'is_connected': 'connected', 'connect_gt24': 'connected_gt24'
+    }
+    agg = grouped[list(flag_counts)].sum().rename(columns=flag_counts)
+    agg.insert(0, 'leads_created', grouped.size())
+    # P50 and P90 come out of a single grouped quantile call, so each column is sorted once per group
+    for column, prefix in [('TimeDiffLeadAttempt_hours', 'attempt'), ('TimeDiffLeadConnect_hours', 'connect')]:
+        percentiles = grouped[column].quantile([0.50, 0.90]).unstack().reindex(columns=[0.50, 0.90])
+        agg[f'{prefix}_p50'] = percentiles[0.50]
+        agg[f'{prefix}_p90'] = percentiles[0.90]
+    return agg
+
+# This function is the engine of the report: every (Source, Period) segment is computed in one pass per grouping.
+def calculate_kpis(df):
+    """Calculates a comprehensive list of KPIs for the Overall and per-source segments of every period."""
+    # Rows without a Period are skipped by groupby itself, so no filtered copy of the leads is needed
+    overall = aggregate_segments(df.groupby('Period', sort=False))
+    overall.index = pd.MultiIndex.from_product([['Overall'], overall.index], names=['Source', 'Period'])
+    by_source = aggregate_segments(df.groupby(['Opportunity Source', 'Period'], observed=True, sort=False))
+    agg = pd.concat([overall, by_source.rename_axis(['Source', 'Period'])])
+
+    def pct(num, den):
+        return (num / den * 100).where(den > 0, 0)
+
+    kpis = pd.DataFrame(index=agg.index)
+    kpis['# of Leads Created (Salesforce)'] = agg['leads_created']
+    kpis['# of Qualified leads'] = agg['qualified']
+    kpis['% Qualified Leads of Leads Created'] = pct(agg['qualified'], agg['leads_created'])
+    kpis['# of Leads Attempted'] = agg['attempted_qual']
+    kpis['Attempt% of Qualified leads'] = pct(agg['attempted_qual'], agg['qualified'])
+    kpis['# of Leads Connected'] = agg['connected_qual']
+    kpis['Connection % of Qualified Leads'] = pct(agg['connected_qual'], agg['qualified'])
+    kpis['Time to First Attempt (P50) in hours'] = agg['attempt_p50']
+    kpis['Time to First Attempt (P90) in hours'] = agg['attempt_p90']
+    kpis['Time to First Connect (P50) in hours'] = agg['connect_p50']
+    kpis['Time to First Connect (P90) in hours'] = agg['connect_p90']
+    kpis['% Contri. of Leads Attempted after 24 hours'] = pct(agg['attempted_gt24'], agg['attempted'])
+    kpis['% Contri. of Leads Contacted after 24 hours'] = pct(agg['connected_gt24'], agg['connected'])
     return kpis
 
 # --- Function to convert DataFrame to Excel in memory ---
 def to_excel(df):
     """Converts a DataFrame to an Excel file in memory (bytes)."""
     output = BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+    # Skip xlsxwriter's per-cell URL/formula/number sniffing; the report only holds plain labels and numbers.
+    # constant_memory is deliberately not used: pandas writes cells column by column, which that mode drops.
+    writer_options = {'strings_to_urls': False, 'strings_to_formulas': False, 'strings_to_numbers': False}
+    with pd.ExcelWriter(output, engine='xlsxwriter', engine_kwargs={'options': writer_options}) as writer:
         df.to_excel(writer, index=False, sheet_name='KPI_Report')
     processed_data = output.getvalue()
     return processed_data
 
+# --- Report Configuration ---
+kpi_group_mapping = {
+    '# of Leads Created (Salesforce)': 'Lead Vol', '# of Qualified leads': 'Lead Vol', '% Qualified Leads of Leads Created': 'Lead Vol',
+    '# of Leads Attempted': 'Lead Attempt', 'Attempt% of Qualified leads': 'Lead Attempt',
+    'Time to First Attempt (P50) in hours': 'Lead Attempt', 'Time to First Attempt (P90) in hours': 'Lead Attempt',
+    '% Contri. of Leads Attempted after 24 hours': 'Lead Attempt',
+    '# of Leads Connected': 'Lead Connect', 'Connection % of Qualified Leads': 'Lead Connect',
+    'Time to First Connect (P50) in hours': 'Lead Connect', 'Time to First Connect (P90) in hours': 'Lead Connect',
+    '% Contri. of Leads Contacted after 24 hours': 'Lead Connect'
+}
+# (report column, year, month, last day to include or None for the full month)
+periods_to_analyze = [('April', 2025, 4, None), ('May', 2025, 5, None), ('June MTD (till 19th)', 2025, 6, 19)]
+
+# --- Data Preparation ---
+def load_and_prepare(file_bytes):
+    """Reads the lead master workbook and derives the flag and period columns the KPIs are built from."""
+    # Only load the columns the report uses; the lead master carries many more
+    df = pd.read_excel(BytesIO(file_bytes), engine='calamine', usecols=[
+        'LeadCreateDateTime', 'LeadCreateMonth', 'Opportunity Source', 'isQualified',
+        'is Lead Called?', 'is Lead Connected?', 'TimeDiffLeadAttempt', 'TimeDiffLeadConnect'
+    ])
+    df = df.rename(columns={
+        'is Lead Called?': 'is_Lead_Called',
+        'is Lead Connected?': 'is_Lead_Connected',
+        'TimeDiffLeadAttempt': 'TimeDiffLeadAttempt_hours',
+        'TimeDiffLeadConnect': 'TimeDiffLeadConnect_hours'
+    })
+    # Downcast the 0/1 flags once; every KPI pass scans them. Only a numeric 1 counts as flagged, as before.
+    flag_columns = ['isQualified', 'is_Lead_Called', 'is_Lead_Connected']
+    df[flag_columns] = df[flag_columns].apply(pd.to_numeric, errors='coerce').eq(1).astype('int8')
+    df['LeadCreateDateTime_dt'] = pd.to_datetime(df['LeadCreateDateTime'], errors='coerce')
+    df.dropna(subset=['LeadCreateDateTime_dt', 'LeadCreateMonth', 'Opportunity Source'], inplace=True)
+    # A handful of sources repeat across every lead, so group on categorical codes rather than strings
+    df['Opportunity Source'] = df['Opportunity Source'].astype('category')
+
+    # Pre-compute the boolean flags every KPI is counted from
+    df['is_qualified'] = df['isQualified'] == 1
+    df['is_attempted'] = df['is_Lead_Called'] == 1
+    df['is_connected'] = df['is_Lead_Connected'] == 1
+    df['is_attempted_qual'] = df['is_qualified'] & df['is_attempted']
+    df['is_connected_qual'] = df['is_qualified'] & df['is_connected']
+    df['attempt_gt24'] = df['is_attempted'] & (df['TimeDiffLeadAttempt_hours'] > 24)
+    df['connect_gt24'] = df['is_connected'] & (df['TimeDiffLeadConnect_hours'] > 24)
+
+    # Extract the date parts once as small integers; the period filters below only compare these
+    created = df['LeadCreateDateTime_dt'].dt
+    df['_y'] = created.year.astype('int16')
+    df['_m'] = created.month.astype('int8')
+    df['_d'] = created.day.astype('int8')
+    df.drop(columns=['LeadCreateDateTime', 'LeadCreateDateTime_dt'], inplace=True)
+
+    # Bucket every row into its reporting period once; rows outside all periods are left unassigned
+    df['_ym'] = df['_y'].astype('int32') * 100 + df['_m']
+    ym_to_period = {year * 100 + month: period_name for period_name, year, month, _ in periods_to_analyze}
+    df['Period'] = df['_ym'].map(ym_to_period)
+    for period_name, _, _, day_limit in periods_to_analyze:
+        if day_limit:
+            df.loc[(df['Period'] == period_name) & (df['_d'] > day_limit), 'Period'] = np.nan
+    return df
+
+# --- Report Consolidation ---
+# Streamlit re-runs the whole script on every interaction, so the report is cached on the uploaded file's bytes.
+@st.cache_data(show_spinner=False)
+def build_report(file_bytes):
+    """Builds the consolidated KPI report, one block per source, or returns None if no period has data."""
+    df = load_and_prepare(file_bytes)
+    if df['Period'].isna().all():
+        return None
+    sources_to_analyze = ['Overall'] + sorted(df['Opportunity Source'].cat.categories)
+
+    kpi_table = calculate_kpis(df)
+    sources_with_data = kpi_table.index.unique(level='Source')
+    periods_with_data = kpi_table.index.unique(level='Period')
+    period_columns = [p for p, *_ in periods_to_analyze if p in periods_with_data]
+    kpi_names = list(kpi_table.columns)
+    kpi_table = kpi_table.round(1)
+
+    # Collect the report column by column and build the DataFrame once at the end
+    report = {'Source': [], 'Overall Leads': [], 'KPIs': [], **{p: [] for p in period_columns}}
+    for source in sources_to_analyze:
+        if source not in sources_with_data: continue
+        # Add 2 blank rows between consecutive segments
+        if report['Source']:
+            for column in report.values():
+                column.extend(['', ''])
+        source_kpis = kpi_table.loc[source].reindex(period_columns)
+        report['Source'].extend([source] * len(kpi_names))
+        report['Overall Leads'].extend(kpi_group_mapping[k] for k in kpi_names)
+        report['KPIs'].extend(kpi_names)
+        for period_name in period_columns:
+            report[period_name].extend(source_kpis.loc[period_name].tolist())
+
+    if not report['Source']:
+        return None
+    return pd.DataFrame(report)
+
 # --- Main Application UI and Logic ---
 st.title("📊 KPI Report Generator")
 st.markdown("Upload your lead master Excel file to generate a downloadable, consolidated KPI report.")
@@ -67,60 +179,11 @@ uploaded_file = st.file_uploader(
 if uploaded_file is not None:
     with st.spinner("Processing your file..."):
         try:
-            # 1. Data Preparation
-            df = pd.read_excel(uploaded_file)
-            df = df.rename(columns={
-                'is Lead Called?': 'is_Lead_Called',
-                'is Lead Connected?': 'is_Lead_Connected',
-                'TimeDiffLeadAttempt': 'TimeDiffLeadAttempt_hours',
-                'TimeDiffLeadConnect': 'TimeDiffLeadConnect_hours'
-            })
-            df['LeadCreateDateTime_dt'] = pd.to_datetime(df['LeadCreateDateTime'], errors='coerce')
-            df['LeadCreateMonth'] = df['LeadCreateMonth'].astype(str)
-            df.dropna(subset=['LeadCreateDateTime_dt', 'LeadCreateMonth', 'Opportunity Source'], inplace=True)
-            
-            # 2. Main Loop and Report Consolidation
-            kpi_group_mapping = {
-                '# of Leads Created (Salesforce)': 'Lead Vol', '# of Qualified leads': 'Lead Vol', '% Qualified Leads of Leads Created': 'Lead Vol',
-                '# of Leads Attempted': 'Lead Attempt', 'Attempt% of Qualified leads': 'Lead Attempt',
-                'Time to First Attempt (P50) in hours': 'Lead Attempt', 'Time to First Attempt (P90) in hours': 'Lead Attempt',
-                '% Contri. of Leads Attempted after 24 hours': 'Lead Attempt',
-                '# of Leads Connected': 'Lead Connect', 'Connection % of Qualified Leads': 'Lead Connect',
-                'Time to First Connect (P50) in hours': 'Lead Connect', 'Time to First Connect (P90) in hours': 'Lead Connect',
-                '% Contri. of Leads Contacted after 24 hours': 'Lead Connect'
-            }
-            periods_to_analyze = {'April': '2025-04', 'May': '2025-05', 'June MTD (till 19th)': '2025-06'}
-            sources_to_analyze = ['Overall'] + sorted([s for s in df['Opportunity Source'].unique() if pd.notna(s)])
-            all_reports_list = []
-
-            for source in sources_to_analyze:
-                monthly_kpis_for_source = {}
-                df_source = df[df['Opportunity Source'] == source].copy() if source != 'Overall' else df.copy()
-                for period_name, month_string in periods_to_analyze.items():
-                    if 'MTD' in period_name:
-                        day_limit = int(period_name.split('till ')[1].replace('th','').replace('st','').replace('nd','').replace('rd','').replace(')',''))
-                        df_period = df_source[(df_source['LeadCreateDateTime_dt'].dt.strftime('%Y-%m') == month_string) & (df_source['LeadCreateDateTime_dt'].dt.day <= day_limit)].copy()
-                    else:
-                        df_period = df_source[df_source['LeadCreateDateTime_dt'].dt.strftime('%Y-%m') == month_string].copy()
-                    monthly_kpis_for_source[period_name] = calculate_kpis(df_period)
-                filtered_results = {k: v for k, v in monthly_kpis_for_source.items() if v}
-                if not filtered_results: continue
-                
-                kpi_df = pd.DataFrame(filtered_results).reset_index().rename(columns={'index': 'KPIs'})
-                kpi_df.insert(0, 'Source', source)
-                kpi_df.insert(1, 'Overall Leads', kpi_df['KPIs'].map(kpi_group_mapping))
-                all_reports_list.append(kpi_df)
-                
-                # Add 2 blank rows after each segment's data
-                blank_df = pd.DataFrame([[''] * len(kpi_df.columns)], columns=kpi_df.columns)
-                all_reports_list.append(blank_df)
-                all_reports_list.append(blank_df.copy())
+            # 1. Data Preparation and 2. Report Consolidation (cached per uploaded file)
+            final_report_df = build_report(uploaded_file.getvalue())
             
             # 3. Prepare the final DataFrame and provide a download button
-            if all_reports_list:
-                # Remove the last two blank rows
-                final_report_df = pd.concat(all_reports_list[:-2], ignore_index=True).round(1)
-                
+            if final_report_df is not None:
                 st.success("🎉 Your report has been generated!")
                 st.dataframe(final_report_df) # Show a preview of the report
                 